@@ -25,5 +25,11 @@ setup(
     include_package_data=True,
     install_requires=[
         "requests",
+        "urllib3>=1.26",
     ],
+    extras_require={
+        "async": ["httpx[http2]"],
+        "cache": ["requests-cache>=1.0"],
+        "fast": ["ijson>=3.1", "orjson", "pyarrow"],
+    },
 )
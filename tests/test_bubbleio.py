@@ -0,0 +1,443 @@
+import copy
+import io
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qsl, urlsplit
+
+import pytest
+import requests
+
+from bubbleio import bubbleio as bubbleio_module
+from bubbleio.bubbleio import Bubbleio
+
+API_ROOT = "https://appname.bubbleapps.io/api/1.1/obj"
+
+
+def make_table(n):
+    return [{"_id": "id%d" % i, "rank": i} for i in range(n)]
+
+
+class FakeResponse:
+    """Minimal stand-in for requests.Response, serving one page of a table."""
+
+    def __init__(self, payload):
+        self.content = json.dumps(payload).encode()
+        self.raw = io.BytesIO(self.content)
+        self.from_cache = False
+
+    def raise_for_status(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def serve(tables, page_size=None):
+    """Returns a fake ``session.get`` paginating ``tables`` like Bubble's Data API.
+
+    ``page_size`` caps the pages served, whatever the ``limit`` asked.
+    """
+
+    def get(url, params=None, **kwargs):
+        rows = tables[url.rsplit("/", 1)[1]]
+        cursor = params.get("cursor", 0)
+        limit = min(params.get("limit", 100), page_size or 100)
+        page = rows[cursor : cursor + limit]
+        return FakeResponse(
+            {
+                "response": {
+                    "cursor": cursor,
+                    "results": page,
+                    "count": len(page),
+                    "remaining": max(0, len(rows) - cursor - len(page)),
+                }
+            }
+        )
+
+    return mock.Mock(side_effect=get)
+
+
+@pytest.fixture
+def bbio():
+    with Bubbleio("api_key", API_ROOT) as bbio:
+        yield bbio
+
+
+def test_params_sends_cursor_zero():
+    assert Bubbleio._params(None, 0, None) == {"cursor": 0}
+
+
+def test_get_sends_cursor_zero(bbio):
+    bbio.session.get = serve({"fooType": make_table(3)})
+    bbio.get("fooType", cursor=0)
+    assert bbio.session.get.call_args.kwargs["params"] == {"cursor": 0}
+
+
+@pytest.mark.parametrize("page_size", [None, 30])
+def test_get_all_results_keeps_cursor_order(bbio, page_size):
+    bbio.max_workers = 4
+    bbio.session.get = serve({"fooType": make_table(250)}, page_size)
+    assert bbio.get_all_results("fooType") == make_table(250)
+
+
+def test_get_all_results_single_page(bbio):
+    bbio.session.get = serve({"fooType": make_table(3)})
+    assert bbio.get_all_results("fooType") == make_table(3)
+    assert bbio.session.get.call_count == 1
+
+
+def test_get_many_all_results(bbio):
+    tables = {"fooType": make_table(250), "barType": make_table(5)}
+    bbio.session.get = serve(tables)
+    assert bbio.get_many_all_results(["fooType", "barType"]) == tables
+
+
+@pytest.mark.parametrize("use_ijson", [True, False])
+def test_iter_all_results(bbio, use_ijson):
+    if use_ijson and bubbleio_module.ijson is None:
+        pytest.skip("ijson is not installed")
+    ijson = bubbleio_module.ijson if use_ijson else None
+    bbio.session.get = serve({"fooType": make_table(250)}, page_size=30)
+    with mock.patch.object(bubbleio_module, "ijson", ijson):
+        assert list(bbio.iter_all_results("fooType")) == make_table(250)
+
+
+def async_transport(tables, failures=0):
+    """Returns an httpx transport paginating ``tables``, answering 429 to the first
+    ``failures`` calls."""
+    httpx = pytest.importorskip("httpx")
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        if len(calls) <= failures:
+            return httpx.Response(429, headers={"Retry-After": "0"})
+        params = {k: int(v) for k, v in request.url.params.items()}
+        return httpx.Response(
+            200, content=serve(tables)(str(request.url.path), params).content
+        )
+
+    return httpx.MockTransport(handler), calls
+
+
+def mock_async_client(transport):
+    httpx = pytest.importorskip("httpx")
+    client = httpx.AsyncClient
+    return mock.patch.object(
+        httpx,
+        "AsyncClient",
+        lambda **kwargs: client(
+            transport=transport, **{k: v for k, v in kwargs.items() if k != "http2"}
+        ),
+    )
+
+
+def test_get_all_results_async(bbio):
+    transport, _ = async_transport({"fooType": make_table(250)})
+    with mock_async_client(transport):
+        assert bbio.get_all_results_async("fooType") == make_table(250)
+
+
+def test_get_all_results_async_retries(bbio):
+    transport, calls = async_transport({"fooType": make_table(250)}, failures=2)
+    with mock_async_client(transport):
+        assert bbio.get_all_results_async("fooType") == make_table(250)
+    assert len(calls) == 3 + 2
+
+
+@pytest.fixture
+def http_server():
+    """Serves ``server.tables`` over HTTP, answering 429 to the first
+    ``server.failures`` calls."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            server.calls += 1
+            if server.calls <= server.failures:
+                self.send_response(429)
+                self.send_header("Retry-After", "0")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            url = urlsplit(self.path)
+            params = {k: int(v) for k, v in parse_qsl(url.query)}
+            body = serve(server.tables)(url.path, params).content
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.calls = 0
+    server.failures = 0
+    server.tables = {}
+    server.api_root = "http://127.0.0.1:%d/api/1.1/obj" % server.server_port
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    # "Retry-After: 0" falls back to backoff in urllib3
+    with mock.patch.object(Bubbleio, "BACKOFF_FACTOR", 0):
+        yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_get_all_results_retries(http_server):
+    http_server.tables = {"fooType": make_table(250)}
+    http_server.failures = 2
+    with Bubbleio("api_key", http_server.api_root) as bbio:
+        assert bbio.get_all_results("fooType") == make_table(250)
+    assert http_server.calls == 3 + 2
+
+
+@pytest.mark.parametrize("use_ijson", [True, False])
+def test_exhausted_retries_raise_http_error(http_server, use_ijson):
+    if use_ijson and bubbleio_module.ijson is None:
+        pytest.skip("ijson is not installed")
+    ijson = bubbleio_module.ijson if use_ijson else None
+    http_server.failures = Bubbleio.RETRIES + 1
+    with Bubbleio("api_key", http_server.api_root) as bbio:
+        with mock.patch.object(bubbleio_module, "ijson", ijson):
+            with pytest.raises(requests.HTTPError) as e:
+                list(bbio.iter_all_results("fooType"))
+    assert e.value.response.status_code == 429
+    assert http_server.calls == Bubbleio.RETRIES + 1
+
+
+def test_get_all_results_as_df(bbio):
+    table = [{"_id": "a", "tags": ["x"], "name": "A"}, {"_id": "b", "rank": 2}]
+    bbio.session.get = serve({"fooType": table})
+    df = bbio.get_all_results_as_df("fooType")
+    assert df.shape == (2, 4)
+    assert df.loc[0, "tags"] == ["x"]
+    assert df.isna().loc[1, "name"]
+
+
+def test_get_all_results_as_df_masking_every_field(bbio):
+    bbio.session.get = serve({"fooType": make_table(3)})
+    df = bbio.get_all_results_as_df("fooType", mask_fields=["_id", "rank"])
+    assert df.shape == (3, 0)
+
+
+def test_get_all_results_as_df_pyarrow(bbio):
+    pytest.importorskip("pyarrow")
+    bbio.session.get = serve({"fooType": make_table(3)})
+    df = bbio.get_all_results_as_df("fooType", dtype_backend="pyarrow")
+    assert str(df["rank"].dtype) == "int64[pyarrow]"
+    df = bbio.get_all_results_as_df(
+        "fooType", mask_fields=["_id", "rank"], dtype_backend="pyarrow"
+    )
+    assert df.shape == (3, 0)
+
+
+def join_tables():
+    return {
+        "fooType": [
+            {"_id": "f%d" % i, "bar": "b%d" % (i % 3), "baz": "b%d" % (i % 2)}
+            for i in range(5)
+        ]
+        + [{"_id": "f5", "bar": "unknown"}],
+        "barType": [{"_id": "b%d" % i, "label": "L%d" % i} for i in range(3)],
+    }
+
+
+def test_get_all_results_as_df_joins(bbio):
+    bbio.session.get = serve(join_tables())
+    df = bbio.get_all_results_as_df(
+        "fooType", joins=[{"field": "bar", "typename": "barType"}]
+    )
+    assert list(df.columns) == ["_id", "bar", "baz", "bar__id", "bar_label"]
+    assert list(df["bar_label"][:5]) == ["L0", "L1", "L2", "L0", "L1"]
+    assert df.isna().loc[5, "bar_label"]
+
+
+def test_get_all_results_as_df_same_field_joined_twice(bbio):
+    bbio.session.get = serve(join_tables())
+    join = {"field": "bar", "typename": "barType"}
+    df = bbio.get_all_results_as_df("fooType", joins=[join, join])
+    assert list(df.columns) == [
+        "_id",
+        "bar",
+        "baz",
+        "bar__id_x",
+        "bar_label_x",
+        "bar__id_y",
+        "bar_label_y",
+    ]
+
+
+def test_get_all_results_as_df_impossible_join_is_skipped(bbio, caplog):
+    tables = dict(join_tables(), emptyType=[])
+    bbio.session.get = serve(tables)
+    df = bbio.get_all_results_as_df(
+        "fooType",
+        joins=[
+            {"field": "missing", "typename": "barType"},
+            {"field": "baz", "typename": "emptyType"},
+            {"field": "bar", "typename": "barType"},
+        ],
+    )
+    assert list(df.columns) == ["_id", "bar", "baz", "bar__id", "bar_label"]
+    assert caplog.text.count("Join impossible") == 2
+
+
+def test_disk_cache_gives_back_the_same_records(tmp_path):
+    table = [
+        {"_id": "a", "o": {"k": 1}, "v": 1, "l": [{"k": 1}], "n": None},
+        {"_id": "b", "o": {"j": "x"}, "v": 2.5, "l": [{"j": "x"}]},
+    ]
+    with Bubbleio("api_key", API_ROOT, cache_dir=str(tmp_path)) as bbio:
+        bbio.session.get = serve({"fooType": table})
+        assert bbio.get_all_results("fooType") == table
+        cached = bbio.get_all_results("fooType")
+        assert bbio.session.get.call_count == 1
+    assert cached == table
+    assert [list(r) for r in cached] == [list(r) for r in table]
+    assert type(cached[0]["v"]) is int
+
+
+def test_disk_cache_expires(tmp_path):
+    with Bubbleio("api_key", API_ROOT, cache_dir=str(tmp_path), cache_ttl=-1) as bbio:
+        bbio.session.get = serve({"fooType": make_table(3)})
+        bbio.get_all_results("fooType")
+        bbio.get_all_results("fooType")
+        assert bbio.session.get.call_count == 2
+
+
+def test_disk_cache_write_failure_is_not_raised(tmp_path, caplog):
+    cache_dir = tmp_path / "cache"
+    cache_dir.write_text("not a directory")
+    with Bubbleio("api_key", API_ROOT, cache_dir=str(cache_dir)) as bbio:
+        bbio.session.get = serve({"fooType": make_table(3)})
+        assert bbio.get_all_results("fooType") == make_table(3)
+    assert "not cached" in caplog.text
+
+
+def test_disk_cache_leaves_no_temporary_file(tmp_path):
+    with Bubbleio("api_key", API_ROOT, cache_dir=str(tmp_path)) as bbio:
+        bbio._write_disk_cache("fooType", None, [{"_id": "a", "v": {1, 2}}])
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_get_all_results_as_df_force_refresh(tmp_path):
+    joins = [{"field": "bar", "typename": "barType"}]
+    with Bubbleio("api_key", API_ROOT, cache_dir=str(tmp_path)) as bbio:
+        bbio.session.get = serve(join_tables())
+        bbio.get_all_results_as_df("fooType", joins=joins)
+        bbio.get_all_results_as_df("fooType", joins=joins)
+        assert bbio.session.get.call_count == 2
+        bbio.get_all_results_as_df("fooType", joins=joins, force_refresh=True)
+        assert bbio.session.get.call_count == 4
+
+
+def test_join_foreign_tables_expire():
+    joins = [{"field": "bar", "typename": "barType"}]
+    with Bubbleio("api_key", API_ROOT, cache_ttl=60) as bbio:
+        bbio.session.get = serve(join_tables())
+        with mock.patch.object(bubbleio_module.time, "monotonic", return_value=0):
+            bbio.get_all_results_as_df("fooType", joins=joins)
+        with mock.patch.object(bubbleio_module.time, "monotonic", return_value=60):
+            bbio.get_all_results_as_df("fooType", joins=joins)
+        assert bbio.session.get.call_count == 3
+        with mock.patch.object(bubbleio_module.time, "monotonic", return_value=61):
+            df = bbio.get_all_results_as_df("fooType", joins=joins)
+        assert bbio.session.get.call_count == 5
+    assert list(df["bar_label"][:3]) == ["L0", "L1", "L2"]
+
+
+@pytest.mark.parametrize("max_workers", [0, -1])
+def test_max_workers_must_be_positive(max_workers):
+    with pytest.raises(ValueError):
+        Bubbleio("api_key", API_ROOT, max_workers=max_workers)
+
+
+def test_stream_results(bbio):
+    bbio.session.get = serve({"fooType": make_table(250)}, page_size=30)
+    pages = list(bbio.stream_results("fooType"))
+    assert [len(page) for page in pages] == [30] * 8 + [10]
+    assert [item for page in pages for item in page] == make_table(250)
+
+
+def test_stream_results_as_batches(bbio):
+    pytest.importorskip("pyarrow")
+    table = [{"_id": "a", "x": 1}, {"_id": "b"}, {"_id": "c", "y": "z"}]
+    bbio.session.get = serve({"fooType": table}, page_size=2)
+    batches = list(bbio.stream_results_as_batches("fooType"))
+    assert [batch.schema.names for batch in batches] == [["_id", "x"], ["_id", "y"]]
+    assert batches[0].to_pylist() == [{"_id": "a", "x": 1}, {"_id": "b", "x": None}]
+    assert batches[1].to_pylist() == [{"_id": "c", "y": "z"}]
+
+
+def fields_table():
+    return [{"_id": "id%d" % i, "rank": i, "name": "n%d" % i} for i in range(250)]
+
+
+def test_fields(bbio):
+    bbio.session.get = serve({"fooType": fields_table()})
+    expected = [{"_id": "id%d" % i, "name": "n%d" % i} for i in range(250)]
+    fields = ["_id", "name", "missing"]
+    assert bbio.get("fooType", fields=fields)["results"] == expected[:100]
+    assert bbio.get_results("fooType", fields=fields) == expected[:100]
+    assert bbio.get_all_results("fooType", fields=fields) == expected
+
+
+def test_fields_are_trimmed_from_the_disk_cache(tmp_path):
+    with Bubbleio("api_key", API_ROOT, cache_dir=str(tmp_path)) as bbio:
+        bbio.session.get = serve({"fooType": fields_table()})
+        bbio.get_all_results("fooType")
+        assert bbio.get_all_results("fooType", fields=["rank"]) == [
+            {"rank": i} for i in range(250)
+        ]
+        assert bbio.session.get.call_count == 3
+
+
+def test_trimmed_tables_are_not_written_to_the_disk_cache(tmp_path):
+    with Bubbleio("api_key", API_ROOT, cache_dir=str(tmp_path)) as bbio:
+        bbio.session.get = serve({"fooType": fields_table()})
+        bbio.get_all_results("fooType", fields=["rank"])
+        assert list(tmp_path.iterdir()) == []
+        assert bbio.get_all_results("fooType") == fields_table()
+        assert bbio.session.get.call_count == 6
+
+
+def test_join_fields(bbio):
+    tables = join_tables()
+    tables["barType"] = [dict(r, extra=1) for r in tables["barType"]]
+    bbio.session.get = serve(tables)
+    joins = [
+        {"field": "bar", "typename": "barType", "list_fields": ["label"]},
+        {"field": "baz", "typename": "barType", "mask_fields": ["_id", "extra"]},
+    ]
+    copies = copy.deepcopy(joins)
+    df = bbio.get_all_results_as_df("fooType", joins=joins)
+    assert list(df.columns) == [
+        "_id",
+        "bar",
+        "baz",
+        "bar_label",
+        "bar__id",
+        "baz__id",
+        "baz_label",
+    ]
+    assert joins == copies
+
+
+def test_join_records_are_cached(bbio):
+    bbio.session.get = serve(join_tables())
+    joins = [{"field": "bar", "typename": "barType"}]
+    bbio.get_all_results_as_df("fooType", joins=joins)
+    bbio.get_all_results_as_df("fooType", joins=joins + joins)
+    assert bbio.session.get.call_count == 3
+    bbio.invalidate_cache("otherType")
+    bbio.get_all_results_as_df("fooType", joins=joins)
+    assert bbio.session.get.call_count == 4
+    bbio.invalidate_cache("barType")
+    bbio.get_all_results_as_df("fooType", joins=joins)
+    assert bbio.session.get.call_count == 6